@@ -5,40 +5,143 @@ Annotate 3d polylines with CVAT.
 | `voxel51.com <https://voxel51.com/>`_
 |
 """
+import functools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 import numpy as np
 
 import fiftyone as fo
 import fiftyone.core.storage as fos
 import fiftyone.operators as foo
 import fiftyone.operators.types as types
-import fiftyone.utils.utils3d as fou3d
-import fiftyone.zoo as foz
 
 
 _PROJECTION_SLICE = "projection"
 _PROJECTION_FIELD = "polyline_2d"
+_WRITE_BATCH_SIZE = 1000
+
+_pcd_slice_cache = {}
+_PCD_SLICE_CACHE_SIZE = 64
+
+
+def _get_pcd_slices(dataset):
+    ## resolve_input() runs on every UI interaction, so memoize the
+    ## slice lookup per (dataset, last modified) rather than hitting
+    ## the database each time
+    key = (str(dataset._doc.id), dataset.last_modified_at)
+    if key not in _pcd_slice_cache:
+        if len(_pcd_slice_cache) >= _PCD_SLICE_CACHE_SIZE:
+            _pcd_slice_cache.pop(next(iter(_pcd_slice_cache)))
+
+        _pcd_slice_cache[key] = [
+            s for s, t in dataset.group_media_types.items() if t in ["pcd", "3d"]
+        ]
+    return _pcd_slice_cache[key]
+
+
+_transform_flat = None
+
+
+def _get_transform_flat():
+    ## Resolve the kernel lazily so importing Numba (or falling back)
+    ## doesn't slow down plugin registration
+    global _transform_flat
+    if _transform_flat is None:
+        try:
+            from numba import njit, prange
+
+            @njit(parallel=True, fastmath=True, cache=True)
+            def _kernel(pts, scales, offsets, out, z):
+                for i in prange(pts.shape[0]):
+                    out[i, 0] = pts[i, 0] * scales[i, 0] + offsets[i, 0]
+                    out[i, 1] = pts[i, 1] * scales[i, 1] + offsets[i, 1]
+                    out[i, 2] = z
+
+        except ImportError:
+            def _kernel(pts, scales, offsets, out, z):
+                out[:, :2] = pts * scales + offsets
+                out[:, 2] = z
+
+        _transform_flat = _kernel
+
+    return _transform_flat
+
+
+def _compute_opm_shard(dataset_name, group_ids, output_dir, pcd_slice):
+    ## utils3d pulls in heavy 3D deps; only pay for it when rendering
+    from fiftyone.utils import utils3d as fou3d
+
+    dataset = fo.load_dataset(dataset_name)
+    fou3d.compute_orthographic_projection_images(
+        dataset.select_groups(group_ids),
+        output_dir=output_dir,
+        size=(-1, 1080),
+        in_group_slice=pcd_slice,
+        out_group_slice=_PROJECTION_SLICE,
+        shading_mode="intensity",
+    )
 
 
 def create_projection_slice_if_necessary(ctx, pcd_slice):
     if _PROJECTION_SLICE not in ctx.dataset.group_slices:
-        ## Create opm
+        ## Create opm, sharding the groups across processes since each
+        ## projection image renders independently
         output_dir = fos.make_temp_dir()
-        fou3d.compute_orthographic_projection_images(
-            ctx.dataset,
-            output_dir=output_dir,
-            size=(-1, 1080),
-            in_group_slice=pcd_slice,
-            out_group_slice=_PROJECTION_SLICE,
-            shading_mode="intensity",
-        )
+        group_ids = ctx.dataset.select_group_slices(pcd_slice).values("group.id")
+
+        ## Workers unpickle the submitted callable by module name, which
+        ## doesn't resolve for dynamically-loaded plugin code, so the
+        ## pool requires a fork start method; fall back to one serial
+        ## in-process pass otherwise
+        try:
+            mp_context = multiprocessing.get_context("fork")
+        except ValueError:
+            mp_context = None
+
+        if mp_context is None or len(group_ids) <= 1:
+            _compute_opm_shard(ctx.dataset.name, group_ids, output_dir, pcd_slice)
+            return
+
+        num_workers = min(os.cpu_count() or 1, len(group_ids)) or 1
+        shards = np.array_split(group_ids, num_workers)
+
+        ## Render the first shard in-process so the projection slice and
+        ## metadata fields are added to the schema exactly once before
+        ## any concurrent workers touch the dataset
+        _compute_opm_shard(ctx.dataset.name, list(shards[0]), output_dir, pcd_slice)
+
+        with ProcessPoolExecutor(num_workers, mp_context=mp_context) as executor:
+            futures = [
+                executor.submit(
+                    _compute_opm_shard,
+                    ctx.dataset.name,
+                    list(shard),
+                    output_dir,
+                    pcd_slice,
+                )
+                for shard in shards[1:]
+                if len(shard) > 0
+            ]
+            for future in futures:
+                future.result()
+
+        ## The workers mutated the dataset in their own processes, so
+        ## refresh the parent's in-memory doc before any views are built
+        ## against the new slice
+        ctx.dataset.reload()
 
 
 def get_anno_tag_view(ctx):
-    view = ctx.dataset
-    if "annotate" in ctx.dataset.select_group_slices(_allow_mixed=True).distinct("tags"):
-        gids = ctx.dataset.select_group_slices(_allow_mixed=True).match_tags("annotate").distinct("group.id")
-        view = ctx.dataset.select_groups(gids)
-    return view
+    ## No need for a separate tag-membership check; if nothing is tagged
+    ## "annotate" the group-id lookup just comes back empty
+    mixed = ctx.dataset.select_group_slices(_allow_mixed=True)
+    gids = mixed.match_tags("annotate").distinct("group.id")
+    if gids:
+        return ctx.dataset.select_groups(gids)
+
+    return ctx.dataset
 
 def get_view(ctx):
     view = get_anno_tag_view(ctx)
@@ -55,23 +158,100 @@ def request_annotation(
     results = view.annotate(anno_key, label_field=_PROJECTION_FIELD, label_type="polylines", classes=classes)
 
 
+@functools.lru_cache(maxsize=256)
+def _affine(min_bound, max_bound):
+    ## Samples from the same sensor rig share identical projection
+    ## bounds, so reuse the scale/offset arrays for repeated metadata
+    scale = np.array(
+        [max_bound[0] - min_bound[0], -(max_bound[1] - min_bound[1])],
+        dtype=np.float32,
+    )
+    offset = np.array(
+        [min_bound[0], min_bound[1] + (max_bound[1] - min_bound[1])],
+        dtype=np.float32,
+    )
+    return scale, offset
+
+
 def polyline_2d_to_3d(polyline_2d, metadata, road_z_value):
     min_bound = metadata.min_bound
     max_bound = metadata.max_bound
-    width = metadata.width
-    height = metadata.height
-    shape = np.array(polyline_2d.points).shape
-    points = np.zeros((shape[0], shape[1], shape[2]+1))
-    points[:,:,-1] = road_z_value
-    points[:,:,:-1] = np.array(polyline_2d.points)
-    points[:,:, 1] *= -1
-    points[:,:, 1] += 1
-    points[:,:, 0] *= (max_bound[0] - min_bound[0])
-    points[:,:, 1] *= (max_bound[1] - min_bound[1])
-    points[:,:, 0] += min_bound[0]
-    points[:,:, 1] += min_bound[1]
-
-    return fo.Polyline(points3d=points.tolist(), label=polyline_2d.label)
+
+    ## Express the transform as one 2x3 homogeneous affine (Y-flip and
+    ## +1 shift folded in) applied via a single einsum
+    H = np.array(
+        [
+            [max_bound[0] - min_bound[0], 0.0, min_bound[0]],
+            [0.0, -(max_bound[1] - min_bound[1]), min_bound[1] + (max_bound[1] - min_bound[1])],
+        ],
+        dtype=np.float32,
+    )
+
+    pts = np.asarray(polyline_2d.points, dtype=np.float32)
+    shape = pts.shape
+
+    ## Work on contiguous (N*M, ...) 2D views so the ufunc loops see
+    ## unit strides
+    flat = pts.reshape(-1, 2)
+    homog = np.hstack([flat, np.ones((flat.shape[0], 1), dtype=np.float32)])
+
+    points = np.empty((flat.shape[0], 3), dtype=np.float32)
+    points[:,:2] = np.einsum("ij,nj->ni", H, homog)
+    points[:,2] = road_z_value
+
+    points3d = points.reshape(shape[0], shape[1], 3)
+    return fo.Polyline(points3d=points3d.tolist(), label=polyline_2d.label)
+
+
+def polylines_2d_to_3d(polylines_2d, metadatas, road_z_value):
+    ## Transform all polylines in one vectorized pass rather than one
+    ## small kernel per polyline
+    if not polylines_2d:
+        return []
+
+    all_pts = []
+    shapes = []
+    lengths = []
+    scales = []
+    offsets = []
+    for polyline_2d, metadata in zip(polylines_2d, metadatas):
+        scale, offset = _affine(tuple(metadata.min_bound), tuple(metadata.max_bound))
+        pts = np.asarray(polyline_2d.points, dtype=np.float32)
+        all_pts.append(pts.reshape(-1, 2))
+        shapes.append(pts.shape)
+        lengths.append(pts.shape[0] * pts.shape[1])
+        scales.append(scale)
+        offsets.append(offset)
+
+    flat_pts = np.concatenate(all_pts, axis=0)
+    scale_rep = np.repeat(np.array(scales), lengths, axis=0)
+    offset_rep = np.repeat(np.array(offsets), lengths, axis=0)
+
+    flat_xyz = np.empty((flat_pts.shape[0], 3), dtype=np.float32)
+    _get_transform_flat()(flat_pts, scale_rep, offset_rep, flat_xyz, road_z_value)
+
+    ## One tolist() on the contiguous flat buffer, then regroup with
+    ## Python slices; much cheaper than a nested tolist() per polyline
+    flat_list = flat_xyz.tolist()
+
+    polylines_3d = []
+    idx = 0
+    for shape, polyline_2d in zip(shapes, polylines_2d):
+        num_shapes, num_points = shape[0], shape[1]
+        points3d = [
+            flat_list[idx + i * num_points:idx + (i + 1) * num_points]
+            for i in range(num_shapes)
+        ]
+        idx += num_shapes * num_points
+        ## from_dict skips per-field validation; the documents are
+        ## validated once when they are saved
+        polylines_3d.append(
+            fo.Polyline.from_dict(
+                {"points3d": points3d, "label": polyline_2d.label}
+            )
+        )
+
+    return polylines_3d
 
 
 def load_annotation(
@@ -87,19 +267,74 @@ def load_annotation(
     results = view.load_annotation_results(anno_key)
 
     # Transform polylines to pcd
-    all_polylines, metadatas, group_ids = view.values([_PROJECTION_FIELD, "orthographic_projection_metadata", "group.id"])
-
+    ## Project down to the fields we need so the aggregation doesn't
+    ## decode entire documents
+    fields = [_PROJECTION_FIELD, "orthographic_projection_metadata"]
+    all_polylines, metadatas, group_ids = view.select_fields(fields).values(fields + ["group.id"])
+
+    flat_polylines = []
+    flat_metadatas = []
+    counts = []
+    for sample_polylines, metadata in zip(all_polylines, metadatas):
+        if sample_polylines is not None and sample_polylines.polylines:
+            flat_polylines.extend(sample_polylines.polylines)
+            flat_metadatas.extend([metadata] * len(sample_polylines.polylines))
+            counts.append(len(sample_polylines.polylines))
+        else:
+            counts.append(0)
+
+    flat_polylines_3d = polylines_2d_to_3d(flat_polylines, flat_metadatas, road_surface)
+
+    ## Only build labels for samples that were actually annotated;
+    ## unlabeled samples are skipped from the write entirely
     polylines_3d = {}
-    for sample_polylines, metadata, group_id in zip(all_polylines, metadatas, group_ids):
-        sample_polylines_3d = []
-        if sample_polylines is not None:
-            for p in sample_polylines.polylines:
-                polyline_3d = polyline_2d_to_3d(p, metadata, road_surface)
-                sample_polylines_3d.append(polyline_3d)
-
-        polylines_3d[group_id] = fo.Polylines(polylines=sample_polylines_3d)
-
-    view._dataset.select_group_slices(pcd_slice).set_values(label_field, polylines_3d, key_field="group.id")
+    idx = 0
+    for count, group_id in zip(counts, group_ids):
+        if count == 0:
+            continue
+
+        polylines_3d[group_id] = fo.Polylines(polylines=flat_polylines_3d[idx:idx + count])
+        idx += count
+
+    if not polylines_3d:
+        return
+
+    pcd_view = view._dataset.select_groups(list(polylines_3d.keys())).select_group_slices(pcd_slice)
+
+    if len(polylines_3d) <= _WRITE_BATCH_SIZE:
+        ## Sort deterministically so the values() call and the positional
+        ## bulk write below resolve the same sample order
+        pcd_view = pcd_view.sort_by("group.id")
+        sample_gids = pcd_view.values("group.id")
+        ordered = [polylines_3d[gid] for gid in sample_gids]
+        pcd_view.set_values(label_field, ordered)
+    else:
+        ## Chunked key-field writes are order-independent, so no sort or
+        ## skip has to be re-evaluated per chunk server-side; the Mongo
+        ## driver releases the GIL on IO so the round trips overlap
+        gids = list(polylines_3d.keys())
+        chunks = [
+            {gid: polylines_3d[gid] for gid in gids[start:start + _WRITE_BATCH_SIZE]}
+            for start in range(0, len(gids), _WRITE_BATCH_SIZE)
+        ]
+        ## Write the first chunk synchronously so the label field is
+        ## added to the dataset schema exactly once before concurrent
+        ## writers run
+        pcd_view.set_values(label_field, chunks[0], key_field="group.id")
+
+        num_workers = min(os.cpu_count() or 1, len(chunks) - 1) or 1
+        with ThreadPoolExecutor(num_workers) as executor:
+            futures = [
+                executor.submit(
+                    pcd_view.set_values,
+                    label_field,
+                    chunk,
+                    key_field="group.id",
+                )
+                for chunk in chunks[1:]
+            ]
+            for future in futures:
+                future.result()
 
 
 class Annotate3DPolyline(foo.Operator):
@@ -117,7 +352,8 @@ class Annotate3DPolyline(foo.Operator):
         classes,
         pcd_slice,
     ):
-        ctx = dict(view=samples.view(), dataset=samples.view()._dataset)
+        view = samples.view()
+        ctx = dict(view=view, dataset=view._dataset)
         params = dict(
             anno_key=anno_key,
             classes=classes,
@@ -138,12 +374,10 @@ class Annotate3DPolyline(foo.Operator):
         )
 
         slice_choices = types.DropdownView(space=6)
-        default_pcd_slice = None
-        for s, t in ctx.dataset.group_media_types.items():
-            if t in ["pcd", "3d"]:
-                slice_choices.add_choice(s, label=s)
-                if default_pcd_slice is None:
-                    default_pcd_slice = s
+        pcd_slices = _get_pcd_slices(ctx.dataset)
+        default_pcd_slice = pcd_slices[0] if pcd_slices else None
+        for s in pcd_slices:
+            slice_choices.add_choice(s, label=s)
         inputs.str(
             "pcd_slice",
             required=True,
@@ -194,7 +428,8 @@ class Load3DPolyline(foo.Operator):
         pcd_slice,
         road_surface=-1.6,
     ):
-        ctx = dict(view=samples.view(), dataset=samples.view()._dataset)
+        view = samples.view()
+        ctx = dict(view=view, dataset=view._dataset)
         params = dict(
             anno_key=anno_key,
             pcd_slice=pcd_slice,
@@ -221,12 +456,10 @@ class Load3DPolyline(foo.Operator):
         )
 
         slice_choices = types.DropdownView(space=6)
-        default_pcd_slice = None
-        for s, t in ctx.dataset.group_media_types.items():
-            if t in ["pcd", "3d"]:
-                slice_choices.add_choice(s, label=s)
-                if default_pcd_slice is None:
-                    default_pcd_slice = s
+        pcd_slices = _get_pcd_slices(ctx.dataset)
+        default_pcd_slice = pcd_slices[0] if pcd_slices else None
+        for s in pcd_slices:
+            slice_choices.add_choice(s, label=s)
 
 
         inputs.str(